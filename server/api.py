@@ -6,53 +6,287 @@ This module handles API requests and responses.
 
 import json
 import logging
+import time
 
 from twisted.web import server, resource
-from twisted.web.client import Agent, readBody
+from twisted.web.client import (
+    Agent,
+    BrowserLikePolicyForHTTPS,
+    HTTPConnectionPool,
+    readBody,
+)
 from twisted.web.http_headers import Headers
 from twisted.internet import defer, reactor
 from twisted.web.iweb import IPolicyForHTTPS
-from twisted.internet.ssl import CertificateOptions
-from twisted.internet._sslverify import ClientTLSOptions
+from twisted.python.failure import Failure
 
 from zope.interface import implementer
 
+from config import (
+    STATIC_API_CACHE_SIZE,
+    STATIC_API_CACHE_TTL,
+    STATIC_API_TIMEOUT,
+)
 from database import retrieve_spammer_data, store_spammer_data
 from p2p import check_p2p_data
 
 LOGGER = logging.getLogger(__name__)
 
+# Keep TLS connections to the static APIs alive between requests
+_POOL = HTTPConnectionPool(reactor, persistent=True)
+_POOL.maxPersistentPerHost = 8
+
+_JSON_CONTENT_TYPE = [b"application/json"]
+_MISSING_USER_ID = b"Missing user_id parameter"
+_INVALID_USER_ID = b"Invalid user_id"
+
+# Telegram user IDs are 64-bit integers, at most 20 decimal digits
+_MAX_USER_ID_LENGTH = 20
+
 
 @implementer(IPolicyForHTTPS)
-class NoVerifyContextFactory:
-    """A context factory that does not verify SSL certificates."""
+class CachingPolicyForHTTPS:
+    """A browser-like TLS policy that builds one client context per host.
 
-    def __init__(self, hostname):
-        self.hostname = hostname
-        self.options = CertificateOptions(verify=False)
+    BrowserLikePolicyForHTTPS creates a new OpenSSL context, loading the
+    system trust store again, for every connection. The static APIs are only
+    a couple of hosts, so their connection creators are kept and reused.
+    """
+
+    def __init__(self):
+        self.policy = BrowserLikePolicyForHTTPS()
+        self.creators = {}
 
     def creatorForNetloc(self, hostname, port):
-        """Function description here"""
-        LOGGER.info("Creating context for %s: %s", hostname, port)
-        return ClientTLSOptions(hostname, self.options.getContext())
+        """Return the cached connection creator for hostname:port."""
+        creator = self.creators.get((hostname, port))
+        if creator is None:
+            LOGGER.info("Creating context for %s: %s", hostname, port)
+            creator = self.policy.creatorForNetloc(hostname, port)
+            self.creators[(hostname, port)] = creator
+        return creator
+
+
+_AGENT = Agent(reactor, contextFactory=CachingPolicyForHTTPS(), pool=_POOL)
 
 
 class APIClient:
     """A helper class to fetch data from static endpoints using Twisted's Agent."""
 
     def __init__(self, hostname):
-        self.agent = Agent(reactor, contextFactory=NoVerifyContextFactory(hostname))
+        self.hostname = hostname
+        self.agent = _AGENT
 
     def fetch_data(self, url):
         """Fetch data from the given URL."""
         return self.agent.request(
             b"GET",
             url.encode("utf-8"),
-            Headers({"User-Agent": ["Twisted P2P spam checker"]}),
+            Headers(
+                {
+                    "User-Agent": ["Twisted P2P spam checker"],
+                    "Connection": ["keep-alive"],
+                }
+            ),
             None,
         ).addCallback(readBody)
 
 
+# Shared clients so every lookup reuses the pooled connections
+API_CLIENT_LOLS = APIClient("api.lols.bot")
+API_CLIENT_CAS = APIClient("api.cas.chat")
+
+# user_id -> (monotonic timestamp, (lols_bot_data, cas_chat_data))
+_API_CACHE = {}
+# user_id -> Deferreds waiting for a lookup that is already running
+_API_IN_FLIGHT = {}
+
+
+def is_valid_user_id(user_id):
+    """Check that user_id (str or bytes) looks like a Telegram user ID."""
+    return (
+        len(user_id) <= _MAX_USER_ID_LENGTH
+        and user_id.isascii()
+        and user_id.isdigit()
+    )
+
+
+def is_spammer_data(lols_bot_data, cas_chat_data):
+    """Determine if decoded LOLS and CAS data mark the user as a spammer."""
+    if lols_bot_data.get("banned"):
+        return True
+    result = cas_chat_data.get("result")
+    return bool(result) and result.get("offenses", 0) > 0
+
+
+def check_static_apis(user_id):
+    """Check the user against the LOLS and CAS APIs.
+
+    Returns a Deferred firing with a (lols_bot_data, cas_chat_data) tuple.
+    Recent results are served from a short TTL cache and concurrent lookups
+    for the same user_id share a single pair of outbound requests.
+    """
+    cached = _API_CACHE.get(user_id)
+    if cached is not None:
+        timestamp, result = cached
+        if time.monotonic() - timestamp < STATIC_API_CACHE_TTL:
+            return defer.succeed(result)
+        del _API_CACHE[user_id]
+
+    waiter = defer.Deferred()
+    waiters = _API_IN_FLIGHT.get(user_id)
+    if waiters is not None:
+        waiters.append(waiter)
+        return waiter
+    _API_IN_FLIGHT[user_id] = [waiter]
+
+    LOGGER.info("Checking static APIs for user_id: %s", user_id)
+    lols_bot_url = f"https://api.lols.bot/account?id={user_id}"
+    cas_chat_url = f"https://api.cas.chat/check?user_id={user_id}"
+    d = defer.gatherResults(
+        [
+            API_CLIENT_LOLS.fetch_data(lols_bot_url),
+            API_CLIENT_CAS.fetch_data(cas_chat_url),
+        ],
+        consumeErrors=True,
+    )
+    d.addErrback(_unwrap_first_error)
+    # Cancels both outstanding requests when it fires
+    d.addTimeout(STATIC_API_TIMEOUT, reactor)
+    d.addCallback(_parse_static_api_responses)
+    d.addBoth(_resolve_static_api_lookup, user_id)
+    return waiter
+
+
+def _unwrap_first_error(failure):
+    """Replace a gatherResults FirstError with the failure that caused it."""
+    failure.trap(defer.FirstError)
+    return failure.value.subFailure
+
+
+def _parse_static_api_responses(responses):
+    """Decode the raw LOLS and CAS response bodies.
+
+    Both must be JSON objects, anything else fails the lookup so it is never
+    cached.
+    """
+    lols_bot_response, cas_chat_response = responses
+    if LOGGER.isEnabledFor(logging.DEBUG):
+        LOGGER.debug("LOLS bot response: %s", lols_bot_response.decode("utf-8"))
+        LOGGER.debug("CAS chat response: %s", cas_chat_response.decode("utf-8"))
+    lols_bot_data = json.loads(lols_bot_response)
+    cas_chat_data = json.loads(cas_chat_response)
+    if not isinstance(lols_bot_data, dict) or not isinstance(cas_chat_data, dict):
+        raise ValueError("Static API response is not a JSON object")
+    return lols_bot_data, cas_chat_data
+
+
+def _resolve_static_api_lookup(result, user_id):
+    """Cache a finished lookup and hand the result to every waiter."""
+    waiters = _API_IN_FLIGHT.pop(user_id)
+    if isinstance(result, Failure):
+        for waiter in waiters:
+            waiter.errback(result)
+        return None
+
+    if len(_API_CACHE) >= STATIC_API_CACHE_SIZE:
+        now = time.monotonic()
+        # Entries are inserted in timestamp order, so the expired ones are all
+        # at the front and the scan stops at the first fresh entry
+        expired = []
+        for key, (timestamp, _) in _API_CACHE.items():
+            if now - timestamp < STATIC_API_CACHE_TTL:
+                break
+            expired.append(key)
+        for key in expired:
+            del _API_CACHE[key]
+        if len(_API_CACHE) >= STATIC_API_CACHE_SIZE:
+            # Still full of fresh entries, drop the oldest one
+            del _API_CACHE[next(iter(_API_CACHE))]
+    _API_CACHE[user_id] = (time.monotonic(), result)
+
+    for waiter in waiters:
+        waiter.callback(result)
+    return None
+
+
+def spammer_response_body(user_id, is_spammer, lols_bot_json, cas_chat_json, p2p_json):
+    """Build a lookup response around already serialized JSON documents.
+
+    The documents are spliced in as-is, so data read from the database or
+    serialized for storage is never decoded and encoded again.
+    """
+    return (
+        '{"ok": true, "user_id": "%s", "is_spammer": %s, '
+        '"lols_bot": %s, "cas_chat": %s, "p2p": %s}'
+        % (
+            user_id,
+            "true" if is_spammer else "false",
+            lols_bot_json or "null",
+            cas_chat_json or "null",
+            p2p_json or "null",
+        )
+    ).encode("utf-8")
+
+
+def send_json_body(request, body):
+    """Write an encoded JSON body and finish the request."""
+    if request.channel is None:
+        # The client went away while the response was being prepared
+        return
+    request.responseHeaders.setRawHeaders(b"content-type", _JSON_CONTENT_TYPE)
+    request.write(body)
+    request.finish()
+
+
+def send_json_response(request, response):
+    """Write the response as a JSON body and finish the request."""
+    send_json_body(request, json.dumps(response).encode("utf-8"))
+
+
+def _on_request_lost(failure, user_id):
+    """Log a client that disconnected before its response was sent."""
+    LOGGER.info(
+        "Client for user_id %s disconnected: %s", user_id, failure.getErrorMessage()
+    )
+
+
+def _handle_static_api_response(responses, request, user_id):
+    """Store the static API results and answer the pending request."""
+    lols_bot_data, cas_chat_data = responses
+
+    is_spammer = is_spammer_data(lols_bot_data, cas_chat_data)
+
+    p2p_data = check_p2p_data(user_id)
+
+    # Serialize each document once for both storage and the response
+    lols_bot_json = json.dumps(lols_bot_data)
+    cas_chat_json = json.dumps(cas_chat_data)
+    p2p_json = json.dumps(p2p_data)
+
+    # Store the data in the database
+    store_spammer_data(user_id, lols_bot_json, cas_chat_json, p2p_json)
+
+    body = spammer_response_body(
+        user_id, is_spammer, lols_bot_json, cas_chat_json, p2p_json
+    )
+    send_json_body(request, body)
+    LOGGER.info("Response sent from static APIs for user_id: %s", user_id)
+    LOGGER.debug("Response body: %s", body)
+
+
+def _handle_static_api_error(failure, request, user_id):
+    """Answer the pending request with the static API failure."""
+    LOGGER.error("Error querying APIs: %s", failure)
+    response = {
+        "ok": False,
+        "user_id": user_id,
+        "error": failure.getErrorMessage(),
+    }
+    send_json_response(request, response)
+    LOGGER.info("Error response sent: %s", response)
+
+
 class SpammerCheckResource(resource.Resource):
     """HTTP resource to handle spammer check requests."""
 
@@ -62,119 +296,74 @@ class SpammerCheckResource(resource.Resource):
         """Handle GET requests by fetching data from the database, P2P network, and static APIs."""
         user_id = request.args.get(b"user_id", [None])[0]
         if user_id:
-            user_id = user_id.decode("utf-8")
+            # Reject junk before it reaches the database or the network
+            if not is_valid_user_id(user_id):
+                request.setResponseCode(400)
+                return _INVALID_USER_ID
+            user_id = user_id.decode("ascii")
             LOGGER.info("Received HTTP request for user_id: %s", user_id)
 
             # Check database first
             spammer_data = retrieve_spammer_data(user_id)
             if spammer_data:
-                response = {
-                    "ok": True,
-                    "user_id": user_id,
-                    "is_spammer": self.is_spammer(spammer_data),
-                    "lols_bot": json.loads(spammer_data["lols_bot_data"]),
-                    "cas_chat": json.loads(spammer_data["cas_chat_data"]),
-                    "p2p": json.loads(spammer_data["p2p_data"]),
-                }
-                request.setHeader(b"content-type", b"application/json")
-                request.write(json.dumps(response).encode("utf-8"))
-                request.finish()
-                LOGGER.info("Response sent from database: %s", response)
-                return server.NOT_DONE_YET
+                body = self.stored_response_body(user_id, spammer_data)
+                if body is not None:
+                    send_json_body(request, body)
+                    LOGGER.info("Response sent from database for user_id: %s", user_id)
+                    LOGGER.debug("Response body: %s", body)
+                    return server.NOT_DONE_YET
+                LOGGER.warning(
+                    "Ignoring malformed stored data for user_id: %s", user_id
+                )
 
             # Check P2P network secondly
             p2p_data = check_p2p_data(user_id) # XXX temp dummy None
             logging.debug("P2P data: %s", p2p_data)
             if p2p_data:
-                response = {
-                    "ok": True,
-                    "user_id": user_id,
-                    "is_spammer": self.is_spammer(p2p_data),
-                    "lols_bot": json.loads(p2p_data["lols_bot_data"]),
-                    "cas_chat": json.loads(p2p_data["cas_chat_data"]),
-                    "p2p": json.loads(p2p_data["p2p_data"]),
-                }
-                request.setHeader(b"content-type", b"application/json")
-                request.write(json.dumps(response).encode("utf-8"))
-                request.finish()
-                LOGGER.info("Response sent from P2P network: %s", response)
-                return server.NOT_DONE_YET
+                body = self.stored_response_body(user_id, p2p_data)
+                if body is not None:
+                    send_json_body(request, body)
+                    LOGGER.info(
+                        "Response sent from P2P network for user_id: %s", user_id
+                    )
+                    LOGGER.debug("Response body: %s", body)
+                    return server.NOT_DONE_YET
+                LOGGER.warning("Ignoring malformed P2P data for user_id: %s", user_id)
 
             # Check static APIs finally
-            logging.info("Checking static APIs for user_id: %s", user_id)
-            api_client_lols = APIClient("api.lols.bot")
-            api_client_cas = APIClient("api.cas.chat")
-            lols_bot_url = f"https://api.lols.bot/account?id={user_id}"
-            cas_chat_url = f"https://api.cas.chat/check?user_id={user_id}"
-
-            d1 = api_client_lols.fetch_data(lols_bot_url)
-            d2 = api_client_cas.fetch_data(cas_chat_url)
-            # logging.debug("LOLS response: %s", d1)
-            # logging.debug("CAS response: %s", d2)
-
-            def handle_response(responses):
-                lols_bot_response, cas_chat_response = responses
-                LOGGER.info("LOLS bot response: %s", lols_bot_response.decode("utf-8"))
-                LOGGER.info("CAS chat response: %s", cas_chat_response.decode("utf-8"))
-                lols_bot_data = json.loads(lols_bot_response.decode("utf-8"))
-                cas_chat_data = json.loads(cas_chat_response.decode("utf-8"))
-
-                is_spammer = (
-                    lols_bot_data.get("banned", False)
-                    or cas_chat_data.get("result", {}).get("offenses", 0) > 0
-                )
-
-                p2p_data = check_p2p_data(user_id)
-
-                response = {
-                    "ok": True,
-                    "user_id": user_id,
-                    "is_spammer": is_spammer,
-                    "lols_bot": lols_bot_data,
-                    "cas_chat": cas_chat_data,
-                    "p2p": p2p_data,
-                }
-
-                # Store the data in the database
-                store_spammer_data(
-                    user_id,
-                    json.dumps(lols_bot_data),
-                    json.dumps(cas_chat_data),
-                    json.dumps(p2p_data),
-                )
-
-                request.setHeader(b"content-type", b"application/json")
-                request.write(json.dumps(response).encode("utf-8"))
-                request.finish()
-                LOGGER.info("Response sent from static APIs: %s", response)
-
-            def handle_error(failure):
-                LOGGER.error("Error querying APIs: %s", failure)
-                response = {
-                    "ok": False,
-                    "user_id": user_id,
-                    "error": str(failure),
-                }
-                request.setHeader(b"content-type", b"application/json")
-                request.write(json.dumps(response).encode("utf-8"))
-                request.finish()
-                LOGGER.info("Error response sent: %s", response)
-
-            d = defer.gatherResults([d1, d2])
-            d.addCallback(handle_response)
-            d.addErrback(handle_error)
+            request.notifyFinish().addErrback(_on_request_lost, user_id)
+            d = check_static_apis(user_id)
+            d.addCallback(_handle_static_api_response, request, user_id)
+            d.addErrback(_handle_static_api_error, request, user_id)
             return server.NOT_DONE_YET
         else:
             request.setResponseCode(400)
-            return b"Missing user_id parameter"
+            return _MISSING_USER_ID
+
+    def stored_response_body(self, user_id, data):
+        """Build a response from stored data, or None if a document is malformed.
+
+        Every document is parsed before it is spliced into the response, so
+        text relayed by a peer can never change the structure of the response.
+        """
+        try:
+            is_spammer = self.is_spammer(data)
+            if data["p2p_data"]:
+                json.loads(data["p2p_data"])
+        except (AttributeError, TypeError, ValueError):
+            return None
+        return spammer_response_body(
+            user_id,
+            is_spammer,
+            data["lols_bot_data"],
+            data["cas_chat_data"],
+            data["p2p_data"],
+        )
 
     def is_spammer(self, data):
         """Determine if the user is a spammer based on the data."""
         logging.debug("Checking if user is a spammer: %s", data)
-        lols_bot_data = json.loads(data["lols_bot_data"])
-        cas_chat_data = json.loads(data["cas_chat_data"])
         # TODO add p2p data check
-        return (
-            lols_bot_data.get("banned", False)
-            or cas_chat_data.get("result", {}).get("offenses", 0) > 0
+        return is_spammer_data(
+            json.loads(data["lols_bot_data"]), json.loads(data["cas_chat_data"])
         )
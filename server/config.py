@@ -17,12 +17,41 @@ LOGGER = logging.getLogger(__name__)
 # Default port for P2P server
 DEFAULT_P2P_PORT = 9828
 
+# Seconds outgoing P2P messages are buffered so bursts share one write
+P2P_WRITE_FLUSH_DELAY = 0.005
+
+# Seconds an identical spammer record is not broadcast again, breaks relay loops
+P2P_BROADCAST_DEDUP_TTL = 60
+
+# Maximum number of encoded spammer messages cached, evicted ones are read back
+# from the database
+P2P_MESSAGE_CACHE_SIZE = 10000
+
+# Maximum number of spammer records sent in one synchronization message
+P2P_SYNC_BATCH_SIZE = 1000
+
+# Maximum encoded size in bytes of one synchronization message, kept well
+# below the 8 MiB P2PProtocol.MAX_LENGTH that peers accept
+P2P_SYNC_BATCH_BYTES = 1024 * 1024
+
+# Maximum number of outgoing P2P connection attempts in flight at once
+P2P_MAX_CONCURRENT_CONNECTS = 16
+
 # WebSocket server port
 WEBSOCKET_PORT = 9000
 
 # HTTP server port
 HTTP_PORT = 8081
 
+# Seconds to wait for the static APIs (LOLS/CAS) before giving up
+STATIC_API_TIMEOUT = 5
+
+# Seconds to reuse a static API (LOLS/CAS) lookup before querying again
+STATIC_API_CACHE_TTL = 60
+
+# Maximum number of cached static API lookups
+STATIC_API_CACHE_SIZE = 10000
+
 # Bootstrap addresses for P2P network
 BOOTSTRAP_ADDRESSES = [
     "172.19.113.234:9002",
@@ -31,4 +60,10 @@ BOOTSTRAP_ADDRESSES = [
 ]
 
 # Database file for storing spammer data
-DATABASE_FILE = "spammers.db"
\ No newline at end of file
+DATABASE_FILE = "spammers.db"
+
+# Maximum number of spammer records written to the database in one transaction
+DB_WRITE_BATCH_SIZE = 100
+
+# Seconds the database writer waits to fill a batch before committing
+DB_WRITE_BATCH_INTERVAL = 0.05
@@ -2,59 +2,182 @@
 
 """
 This module handles database operations for storing and retrieving spammer data.
+
+Writes are queued and committed in batches by a background writer thread, so
+store_spammer_data() never blocks the reactor on disk I/O. Reads see queued
+rows immediately.
 """
 
+import queue
 import sqlite3
-from config import DATABASE_FILE, LOGGER
+import threading
+import time
+from config import (
+    DATABASE_FILE,
+    DB_WRITE_BATCH_INTERVAL,
+    DB_WRITE_BATCH_SIZE,
+    LOGGER,
+)
+
+_SQL_CREATE = """
+    CREATE TABLE IF NOT EXISTS spammers (
+        user_id TEXT PRIMARY KEY,
+        lols_bot_data TEXT,
+        cas_chat_data TEXT,
+        p2p_data TEXT
+    )
+"""
+# Updates existing rows in place, REPLACE would delete and re-insert them
+_SQL_UPSERT = """
+    INSERT INTO spammers (user_id, lols_bot_data, cas_chat_data, p2p_data)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        lols_bot_data = excluded.lols_bot_data,
+        cas_chat_data = excluded.cas_chat_data,
+        p2p_data = excluded.p2p_data
+"""
+_SQL_SELECT = """
+    SELECT lols_bot_data, cas_chat_data, p2p_data FROM spammers WHERE user_id = ?
+"""
+# Keyset pagination, each page starts with a primary key index seek
+_SQL_SELECT_PAGE = """
+    SELECT user_id, lols_bot_data, cas_chat_data, p2p_data FROM spammers
+    WHERE user_id > ? ORDER BY user_id LIMIT ?
+"""
+
+# One long-lived connection per thread keeps sqlite3's prepared statement
+# cache warm instead of recompiling every query on a fresh connection
+_LOCAL = threading.local()
+
+# Rows queued for the writer thread, keyed by user_id until they are committed
+_PENDING_WRITES = {}
+_PENDING_LOCK = threading.Lock()
+_WRITE_QUEUE = queue.Queue()
+_STOP_WRITER = object()
+_WRITER = None
+
+# Callables notified with the user_id of every stored record
+_STORE_LISTENERS = []
+
+
+def get_connection():
+    """Return the database connection owned by the calling thread."""
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATABASE_FILE, cached_statements=256)
+        # Safe with WAL: a crash can lose the last commits but never corrupt
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _LOCAL.conn = conn
+    return conn
 
 
 def initialize_database():
-    """Initialize the database and create tables if they don't exist."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS spammers (
-            user_id TEXT PRIMARY KEY,
-            lols_bot_data TEXT,
-            cas_chat_data TEXT,
-            p2p_data TEXT
-        )
-    """
-    )
+    """Initialize the database, create tables and start the writer thread."""
+    global _WRITER  # pylint: disable=global-statement
+    conn = get_connection()
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(_SQL_CREATE)
     conn.commit()
-    conn.close()
+    if _WRITER is None:
+        _WRITER = threading.Thread(
+            target=_write_loop, name="spammer-db-writer", daemon=True
+        )
+        _WRITER.start()
     LOGGER.info("Database initialized")
 
 
+def close_database():
+    """Flush queued writes and stop the writer thread."""
+    global _WRITER  # pylint: disable=global-statement
+    if _WRITER is not None:
+        _WRITE_QUEUE.put(_STOP_WRITER)
+        _WRITER.join()
+        _WRITER = None
+    LOGGER.info("Database closed")
+
+
+def _write_loop():
+    """Commit queued rows in batches of up to DB_WRITE_BATCH_SIZE."""
+    conn = get_connection()
+    stopping = False
+    while not stopping:
+        row = _WRITE_QUEUE.get()
+        if row is _STOP_WRITER:
+            break
+        rows = [row]
+        deadline = time.monotonic() + DB_WRITE_BATCH_INTERVAL
+        while len(rows) < DB_WRITE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                row = _WRITE_QUEUE.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if row is _STOP_WRITER:
+                stopping = True
+                break
+            rows.append(row)
+
+        try:
+            with conn:
+                conn.executemany(_SQL_UPSERT, rows)
+        except sqlite3.Error as e:
+            LOGGER.error("Failed to store %d spammer record(s): %s", len(rows), e)
+            # Retry row by row so only the offending rows are lost
+            stored = 0
+            for row in rows:
+                try:
+                    with conn:
+                        conn.execute(_SQL_UPSERT, row)
+                except sqlite3.Error as row_error:
+                    LOGGER.error(
+                        "Dropped spammer data for user_id %s: %s", row[0], row_error
+                    )
+                else:
+                    stored += 1
+            LOGGER.info("Stored spammer data for %d user(s)", stored)
+        else:
+            LOGGER.info("Stored spammer data for %d user(s)", len(rows))
+
+        with _PENDING_LOCK:
+            for row in rows:
+                if _PENDING_WRITES.get(row[0]) is row:
+                    del _PENDING_WRITES[row[0]]
+
+
+def add_store_listener(listener):
+    """Call listener(user_id) whenever spammer data is stored."""
+    _STORE_LISTENERS.append(listener)
+
+
 def store_spammer_data(user_id, lols_bot_data, cas_chat_data, p2p_data):
-    """Store spammer data in the database."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        INSERT OR REPLACE INTO spammers (user_id, lols_bot_data, cas_chat_data, p2p_data)
-        VALUES (?, ?, ?, ?)
-    """,
-        (user_id, lols_bot_data, cas_chat_data, p2p_data),
-    )
-    conn.commit()
-    conn.close()
-    LOGGER.info("Stored spammer data for user_id: %s", user_id)
+    """Queue spammer data to be stored in the database.
+
+    The data fields must be serialized JSON strings. Anything else is
+    rejected here, on the caller's thread, instead of failing the writer's
+    batch later.
+    """
+    row = (str(user_id), lols_bot_data, cas_chat_data, p2p_data)
+    if not all(isinstance(field, str) for field in row[1:]):
+        raise TypeError(f"Spammer data for user_id {row[0]} must be strings")
+    with _PENDING_LOCK:
+        _PENDING_WRITES[row[0]] = row
+    _WRITE_QUEUE.put(row)
+    for listener in _STORE_LISTENERS:
+        listener(row[0])
+    LOGGER.debug("Queued spammer data for user_id: %s", user_id)
 
 
 def retrieve_spammer_data(user_id):
     """Retrieve spammer data from the database."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        """
-        SELECT lols_bot_data, cas_chat_data, p2p_data FROM spammers WHERE user_id = ?
-    """,
-        (user_id,),
-    )
-    row = cursor.fetchone()
-    conn.close()
+    user_id = str(user_id)
+    with _PENDING_LOCK:
+        row = _PENDING_WRITES.get(user_id)
+    if row is not None:
+        row = row[1:]
+    else:
+        row = get_connection().execute(_SQL_SELECT, (user_id,)).fetchone()
     if row:
         lols_bot_data, cas_chat_data, p2p_data = row
         return {
@@ -66,11 +189,25 @@ def retrieve_spammer_data(user_id):
         return None
 
 
-def get_all_spammer_ids():
-    """Retrieve all spammer IDs from the database."""
-    conn = sqlite3.connect(DATABASE_FILE)
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM spammers")
-    rows = cursor.fetchall()
-    conn.close()
-    return [row[0] for row in rows]
+def retrieve_spammer_data_page(after_user_id, limit):
+    """Return the rows following after_user_id, in user_id order.
+
+    Rows are (user_id, lols_bot_data, cas_chat_data, p2p_data) tuples, at most
+    limit of them come from the database and queued writes within the same
+    range of user_ids replace or join them. Pass "" for the first page, an
+    empty list means there are no more rows.
+    """
+    # Queued rows are read first, a row committed in between is then in the
+    # query result instead
+    with _PENDING_LOCK:
+        pending = [row for row in _PENDING_WRITES.values() if row[0] > after_user_id]
+    rows = get_connection().execute(_SQL_SELECT_PAGE, (after_user_id, limit)).fetchall()
+    # A full page only covers user_ids up to its last one, a short page is the
+    # last and covers every user_id after after_user_id
+    if len(rows) == limit:
+        pending = [row for row in pending if row[0] <= rows[-1][0]]
+    if pending:
+        merged = {row[0]: row for row in rows}
+        merged.update((row[0], row) for row in pending)
+        rows = sorted(merged.values())
+    return rows
@@ -0,0 +1,49 @@
+# json_backend.py
+
+"""
+This module selects the JSON backend once, at import time.
+
+loads() and dumps() use orjson when it is installed and the standard library
+otherwise; dumps() always returns UTF-8 encoded bytes. Parser is the
+simdjson parser class, or None without pysimdjson, and to_python() turns the
+lazy arrays it returns into plain lists.
+"""
+
+import json
+
+try:
+    import orjson
+
+    loads = orjson.loads
+    dumps = orjson.dumps
+except ImportError:
+    loads = json.loads
+
+    def dumps(obj):
+        """Serialize obj to UTF-8 encoded JSON bytes."""
+        return json.dumps(obj).encode("utf-8")
+
+
+def is_json_value(text):
+    """Check that text holds exactly one JSON value and nothing else."""
+    try:
+        loads(text)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+try:
+    import simdjson
+
+    # A parser can be reused, but not while a document it returned is still
+    # referenced, so every consumer creates its own instance
+    Parser = simdjson.Parser
+except ImportError:
+    Parser = None
+
+
+def to_python(value):
+    """Convert a lazy simdjson array into a list, other values are unchanged."""
+    as_list = getattr(value, "as_list", None)
+    return as_list() if as_list is not None else value
@@ -4,69 +4,196 @@
 This module handles P2P connections and data synchronization.
 """
 
-import json
-from twisted.internet import endpoints, defer, error, protocol, reactor
-from database import store_spammer_data, retrieve_spammer_data, get_all_spammer_ids
-from config import LOGGER
+import logging
+import os
+import socket
+import struct
+import time
+from hashlib import blake2b
+from uuid import uuid4
+from twisted.internet import endpoints, defer, protocol, reactor
+from twisted.internet.threads import deferToThread
+from twisted.protocols.basic import Int32StringReceiver, StringTooLongError
+from database import (
+    add_store_listener,
+    retrieve_spammer_data,
+    retrieve_spammer_data_page,
+    store_spammer_data,
+)
+from json_backend import Parser, dumps, is_json_value, loads, to_python
+from config import (
+    LOGGER,
+    P2P_BROADCAST_DEDUP_TTL,
+    P2P_MAX_CONCURRENT_CONNECTS,
+    P2P_MESSAGE_CACHE_SIZE,
+    P2P_SYNC_BATCH_BYTES,
+    P2P_SYNC_BATCH_SIZE,
+    P2P_WRITE_FLUSH_DELAY,
+)
 
 
-class P2PProtocol(protocol.Protocol):
-    """P2P protocol to handle connections and exchange spammer information."""
+def encode_spammer_message(user_id, lols_bot_data, cas_chat_data, p2p_data):
+    """Encode a spammer record as a P2P message."""
+    return dumps(
+        {
+            "user_id": user_id,
+            "lols_bot_data": lols_bot_data,
+            "cas_chat_data": cas_chat_data,
+            "p2p_data": p2p_data,
+        }
+    )
+
+
+def parse_peer_address(address):
+    """Split a "host:port" peer address into its host and integer port."""
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class P2PProtocol(Int32StringReceiver):
+    """P2P protocol to handle connections and exchange spammer information.
+
+    Every message is a JSON document framed with a 4-byte big-endian length
+    prefix, so each stringReceived call gets exactly one complete message.
+    Outgoing messages are buffered for P2P_WRITE_FLUSH_DELAY seconds so a
+    burst of them reaches the transport as a single write.
+    """
+
+    MAX_LENGTH = 8 * 1024 * 1024
 
     def connectionMade(self):
         """Handle new P2P connections."""
-        self.factory.peers.append(self)
-        peer = self.transport.getPeer()
+        self.factory.peers.add(self)
+        # simdjson parsers are reused across messages, one per connection
+        self.parser = Parser() if Parser is not None else None
+        # The remote address is fixed for the lifetime of the connection
+        self.address = peer = self.transport.getPeer()
+        self.factory.peers_by_address[(peer.host, peer.port)] = self
+        # This connection's entry in peer info messages, encoded only once
+        self.peer_info_entry = dumps(
+            {"host": peer.host, "port": peer.port, "uuid": self.factory.uuid}
+        )
+        self.send_buffer = bytearray()
+        self.flush_call = None
         LOGGER.info("P2P connection made with %s:%d", peer.host, peer.port)
-        LOGGER.info("P2P connection details: %s", peer)
+        LOGGER.debug("P2P connection details: %s", peer)
         self.send_peer_info()
 
-    def dataReceived(self, data):
-        """Handle received P2P data."""
-        message = data.decode("utf-8")
-        LOGGER.info("P2P message received: %s", message)
-
+    def stringReceived(self, string):
+        """Handle a received P2P message."""
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug(
+                "P2P message received from %s:%d: %s",
+                self.address.host,
+                self.address.port,
+                string,
+            )
         try:
-            # Split the message by '}{' and add the braces back
-            json_strings = message.split("}{")
-            json_strings = (
-                [json_strings[0] + "}"]
-                + ["{" + s for s in json_strings[1:-1]]
-                + ["{" + json_strings[-1]]
+            message = self.parse_message(string)
+        except ValueError as e:
+            LOGGER.error("Failed to decode JSON: %s", e)
+            return
+        # The parsed document must not outlive handle_message, a
+        # simdjson parser cannot be reused while it is referenced
+        self.handle_message(message)
+
+    def sendString(self, string):
+        """Frame a message and queue it for the next flush."""
+        if len(string) >= 2 ** (8 * self.prefixLength):
+            raise StringTooLongError(
+                f"Try to send {len(string)} bytes whereas maximum is "
+                f"{2 ** (8 * self.prefixLength)}"
+            )
+        self.send_buffer += struct.pack(self.structFormat, len(string))
+        self.send_buffer += string
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(  # pylint: disable=no-member
+                P2P_WRITE_FLUSH_DELAY, self.flush
             )
 
-            for json_string in json_strings:
-                data = json.loads(json_string)
-                if "user_id" in data:
-                    user_id = data["user_id"]
-                    lols_bot_data = data.get("lols_bot_data", "")
-                    cas_chat_data = data.get("cas_chat_data", "")
-                    p2p_data = data.get("p2p_data", "")
-                    store_spammer_data(user_id, lols_bot_data, cas_chat_data, p2p_data)
-                    self.factory.broadcast_spammer_info(user_id)
-                elif "peers" in data:
-                    self.factory.update_peer_list(data["peers"])
-        except json.JSONDecodeError as e:
-            LOGGER.error("Failed to decode JSON: %s", e)
+    def flush(self):
+        """Write all queued messages to the transport at once."""
+        if self.flush_call is not None and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+        if self.send_buffer:
+            self.transport.write(bytes(self.send_buffer))
+            self.send_buffer.clear()
+
+    def lengthLimitExceeded(self, length):
+        """Drop peers that announce an oversized message."""
+        LOGGER.error("P2P message of %d bytes exceeds the limit, disconnecting", length)
+        super().lengthLimitExceeded(length)
+
+    def parse_message(self, data):
+        """Parse a single JSON message from bytes.
+
+        With simdjson the result is a lazy document proxy, fields are only
+        converted to Python objects as handle_message reads them.
+        """
+        if self.parser is None:
+            return loads(data)
+        try:
+            return self.parser.parse(data)
+        except RuntimeError:
+            # A document of this parser is still referenced, from a traceback
+            # for example, so parse with a new one instead of dropping the peer
+            self.parser = Parser()
+            return self.parser.parse(data)
+
+    def handle_message(self, data):
+        """Handle a single decoded P2P message.
+
+        Nested arrays are converted to Python objects before they are passed
+        on, so nothing keeps a simdjson document alive after this returns.
+        """
+        if "user_id" in data:
+            user_id = str(data["user_id"])
+            lols_bot_data = data.get("lols_bot_data", "")
+            cas_chat_data = data.get("cas_chat_data", "")
+            p2p_data = data.get("p2p_data", "")
+            # The fields are spliced verbatim into HTTP responses, each one
+            # must be a string holding exactly one JSON value
+            if not all(
+                isinstance(field, str) and is_json_value(field)
+                for field in (lols_bot_data, cas_chat_data, p2p_data)
+            ):
+                LOGGER.warning("Dropping malformed spammer data for %s", user_id)
+                return
+            message = encode_spammer_message(
+                user_id, lols_bot_data, cas_chat_data, p2p_data
+            )
+            # An unchanged record has already been stored and relayed
+            if self.factory.is_current_spammer_message(user_id, message):
+                LOGGER.debug("Ignoring unchanged spammer data for %s", user_id)
+                return
+            store_spammer_data(user_id, lols_bot_data, cas_chat_data, p2p_data)
+            self.factory.cache_spammer_message(user_id, message)
+            self.factory.broadcast_spammer_info(user_id)
+        elif "peers" in data:
+            self.factory.update_peer_list(to_python(data["peers"]))
+        elif "spammers" in data:
+            for record in to_python(data["spammers"]):
+                self.handle_message(record)
 
     def connectionLost(self, reason=protocol.connectionDone):
         """Handle lost P2P connections."""
-        self.factory.peers.remove(self)
+        if self.flush_call is not None:
+            self.flush_call.cancel()
+            self.flush_call = None
+        self.factory.peers.discard(self)
+        peer = self.address
+        if self.factory.peers_by_address.get((peer.host, peer.port)) is self:
+            del self.factory.peers_by_address[(peer.host, peer.port)]
         LOGGER.info("P2P connection lost: %s", reason)
 
     def send_peer_info(self):
         """Send the list of known peers to the connected peer."""
-        peer_info = [
-            {
-                "host": peer.transport.getPeer().host,
-                "port": peer.transport.getPeer().port,
-                "uuid": self.factory.uuid,
-            }
-            for peer in self.factory.peers
-        ]
-        message = json.dumps({"peers": peer_info})
-        self.transport.write(message.encode("utf-8"))
-        LOGGER.info("Sent peer info: %s", message)
+        message = b'{"peers":[%s]}' % b",".join(
+            peer.peer_info_entry for peer in self.factory.peers
+        )
+        self.sendString(message)
+        LOGGER.debug("Sent peer info: %s", message)
 
 
 class P2PFactory(protocol.Factory):
@@ -74,36 +201,165 @@ class P2PFactory(protocol.Factory):
 
     protocol = P2PProtocol
 
-    def __init__(self, uuid):
-        self.peers = []
-        self.uuid = uuid
+    def __init__(self, node_uuid=None):
+        # Connected protocols, a set so a disconnect is removed in constant time
+        self.peers = set()
+        # (host, port) -> connected protocol, for constant time lookups
+        self.peers_by_address = {}
+        self.uuid = node_uuid or uuid4().hex
         self.bootstrap_peers = ["172.19.113.234:9002", "172.19.112.1:9001"]
+        # user_id -> encoded spammer message, dropped whenever the row is stored,
+        # oldest first
+        self.message_cache = {}
+        # user_id -> token of the latest database read that may fill the cache
+        self.message_loads = {}
+        # Addresses with an outgoing connection attempt queued or in progress
+        self.connecting = set()
+        # Caps simultaneous outgoing connects when a large peer list arrives
+        self.connect_limit = defer.DeferredSemaphore(P2P_MAX_CONCURRENT_CONNECTS)
+        # message digest -> monotonic time of its last broadcast, oldest first
+        self.recent_broadcasts = {}
+        add_store_listener(self.invalidate_spammer_message)
+
+    def spammer_message(self, user_id):
+        """Return a Deferred firing with the encoded spammer message for user_id.
+
+        Fires with None if the user is unknown. Messages missing from the cache
+        are read from the database in a worker thread.
+        """
+        user_id = str(user_id)
+        message = self.message_cache.get(user_id)
+        if message is not None:
+            return defer.succeed(message)
+        token = self.message_loads[user_id] = object()
+        d = deferToThread(retrieve_spammer_data, user_id)
+        d.addCallback(self._encode_loaded_spammer_data, user_id, token)
+        return d
+
+    def _encode_loaded_spammer_data(self, spammer_data, user_id, token):
+        """Encode a spammer record read from the database and cache it."""
+        if not spammer_data:
+            return None
+        message = encode_spammer_message(
+            user_id,
+            spammer_data["lols_bot_data"],
+            spammer_data["cas_chat_data"],
+            spammer_data["p2p_data"],
+        )
+        # A record stored while the read was running makes the result stale
+        if self.message_loads.get(user_id) is token:
+            del self.message_loads[user_id]
+            self.cache_spammer_message(user_id, message)
+        return message
+
+    def is_current_spammer_message(self, user_id, message):
+        """Check whether message encodes the record stored for user_id.
+
+        The cache answers when it holds user_id. On a miss, records relayed
+        after a synchronization for example, the stored row is compared
+        instead, queued writes included.
+        """
+        cached = self.message_cache.get(user_id)
+        if cached is not None:
+            return cached == message
+        # A primary key lookup, cheap enough to run on the reactor thread, and
+        # nothing can be stored between the read and the decision
+        spammer_data = retrieve_spammer_data(user_id)
+        if not spammer_data:
+            return False
+        stored = encode_spammer_message(
+            user_id,
+            spammer_data["lols_bot_data"],
+            spammer_data["cas_chat_data"],
+            spammer_data["p2p_data"],
+        )
+        if stored != message:
+            return False
+        self.cache_spammer_message(user_id, message)
+        return True
+
+    def cache_spammer_message(self, user_id, message):
+        """Cache the encoded message of the current record for user_id.
+
+        The oldest entry is evicted at P2P_MESSAGE_CACHE_SIZE. Eviction only
+        costs a database read, is_current_spammer_message falls back to the
+        stored row so an evicted record is never taken for a new one.
+        """
+        self.message_cache.pop(user_id, None)
+        if len(self.message_cache) >= P2P_MESSAGE_CACHE_SIZE:
+            del self.message_cache[next(iter(self.message_cache))]
+        self.message_cache[user_id] = message
+
+    def invalidate_spammer_message(self, user_id):
+        """Forget the encoded message of a spammer record that changed."""
+        self.message_cache.pop(user_id, None)
+        self.message_loads.pop(user_id, None)
 
     def broadcast_spammer_info(self, user_id):
         """Broadcast spammer information to all connected peers."""
-        spammer_data = retrieve_spammer_data(user_id)
-        if spammer_data:
-            message = json.dumps(
-                {
-                    "user_id": user_id,
-                    "lols_bot_data": spammer_data["lols_bot_data"],
-                    "cas_chat_data": spammer_data["cas_chat_data"],
-                    "p2p_data": spammer_data["p2p_data"],
-                }
+        d = self.spammer_message(user_id)
+        d.addCallback(self._send_spammer_message, user_id)
+        d.addErrback(
+            lambda failure: LOGGER.error(
+                "Failed to broadcast spammer info for user_id %s: %s",
+                user_id,
+                failure,
             )
+        )
+        return d
+
+    def _send_spammer_message(self, message, user_id):
+        """Send an encoded spammer message to all connected peers."""
+        if message is not None:
+            if self.recently_broadcast(message):
+                LOGGER.debug("Skipping repeated broadcast for user_id: %s", user_id)
+                return
             for peer in self.peers:
-                peer.transport.write(message.encode("utf-8"))
-            LOGGER.info("Broadcasted spammer info: %s", message)
+                peer.sendString(message)
+            LOGGER.debug(
+                "Broadcasted spammer info for user_id %s to %d peer(s): %s",
+                user_id,
+                len(self.peers),
+                message,
+            )
         else:
             LOGGER.warning("No spammer data found for user_id: %s", user_id)
 
+    def recently_broadcast(self, message):
+        """Check whether message was broadcast in the last P2P_BROADCAST_DEDUP_TTL.
+
+        Messages are remembered by a digest of their content, so records
+        relayed around a cycle of peers stop after one round while a changed
+        record for the same user_id is still broadcast.
+        """
+        digest = blake2b(message, digest_size=16).digest()
+        now = time.monotonic()
+        sent_at = self.recent_broadcasts.get(digest)
+        if sent_at is not None and now - sent_at < P2P_BROADCAST_DEDUP_TTL:
+            return True
+        # Entries are kept in broadcast order, so the expired ones are a prefix.
+        # Expiring by age rather than count keeps every digest for the full TTL
+        expired = []
+        for old_digest, old_sent_at in self.recent_broadcasts.items():
+            if now - old_sent_at < P2P_BROADCAST_DEDUP_TTL:
+                break
+            expired.append(old_digest)
+        for old_digest in expired:
+            del self.recent_broadcasts[old_digest]
+        self.recent_broadcasts[digest] = now
+        return False
+
     def connect_to_bootstrap_peers(self, bootstrap_addresses):
-        """Connect to bootstrap peers and gather available peers."""
+        """Connect to bootstrap peers and gather available peers.
+
+        Addresses are "host:port" strings, the host may be a DNS name or an
+        address. Like every outgoing P2P connection they are dialed with
+        HostnameEndpoint, which resolves the name and races the results.
+        """
         deferreds = []
         for address in bootstrap_addresses:
-            host, port = address.split(":")
-            port = int(port)
-            endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port)
+            host, port = parse_peer_address(address)
+            endpoint = endpoints.HostnameEndpoint(reactor, host, port)
             deferred = endpoint.connect(self)
             deferred.addCallback(self.on_bootstrap_peer_connected)
             deferred.addErrback(self.on_bootstrap_peer_failed, address)
@@ -112,10 +368,14 @@ class P2PFactory(protocol.Factory):
 
     def on_bootstrap_peer_connected(self, protocol):
         """Handle successful connection to a bootstrap peer."""
-        peer = protocol.transport.getPeer()
+        peer = protocol.address
         LOGGER.info("Connected to bootstrap peer %s:%d", peer.host, peer.port)
         self.bootstrap_peers.append(protocol)
-        self.synchronize_spammer_data(protocol)
+        self.synchronize_spammer_data(protocol).addErrback(
+            lambda failure: LOGGER.error(
+                "Failed to synchronize with %s:%d: %s", peer.host, peer.port, failure
+            )
+        )
 
     def on_bootstrap_peer_failed(self, failure, address):
         """Handle failed connection to a bootstrap peer."""
@@ -124,8 +384,19 @@ class P2PFactory(protocol.Factory):
     def update_peer_list(self, peers):
         """Update the list of known peers."""
         for peer in peers:
-            host = peer["host"]
-            port = peer["port"]
+            if not isinstance(peer, dict):
+                LOGGER.warning("Ignoring invalid peer entry %r", peer)
+                continue
+            host = peer.get("host")
+            port = peer.get("port")
+            if not (
+                isinstance(host, str)
+                and isinstance(port, int)
+                and not isinstance(port, bool)
+                and 0 < port < 65536
+            ):
+                LOGGER.warning("Ignoring invalid peer address %r:%r", host, port)
+                continue
             peer_uuid = peer.get("uuid")
             if peer_uuid == self.uuid:
                 LOGGER.info(
@@ -135,52 +406,102 @@ class P2PFactory(protocol.Factory):
                     peer_uuid,
                 )
                 continue
-            if not any(
-                p.transport.getPeer().host == host
-                and p.transport.getPeer().port == port
-                for p in self.peers
-            ):
-                endpoint = endpoints.TCP4ClientEndpoint(reactor, host, port)
-                endpoint.connect(self).addCallback(
-                    lambda _: LOGGER.info("Connected to new peer %s:%d", host, port)
-                ).addErrback(
-                    lambda err: LOGGER.error(
-                        "Failed to connect to new peer %s:%d: %s", host, port, err
-                    )
+            address = (host, port)
+            if address in self.peers_by_address or address in self.connecting:
+                continue
+            self.connecting.add(address)
+            endpoint = endpoints.HostnameEndpoint(reactor, host, port)
+            d = self.connect_limit.run(endpoint.connect, self)
+            d.addCallback(
+                lambda _, host=host, port=port: LOGGER.info(
+                    "Connected to new peer %s:%d", host, port
                 )
-                LOGGER.info("Connecting to new peer %s:%d", host, port)
+            )
+            d.addErrback(
+                lambda err, host=host, port=port: LOGGER.error(
+                    "Failed to connect to new peer %s:%d: %s", host, port, err
+                )
+            )
+            d.addBoth(lambda _, address=address: self.connecting.discard(address))
+            LOGGER.info("Connecting to new peer %s:%d", host, port)
 
+    @defer.inlineCallbacks
     def synchronize_spammer_data(self, protocol):
-        """Synchronize spammer data with a newly connected peer."""
-        for user_id in self.get_all_spammer_ids():
-            spammer_data = retrieve_spammer_data(user_id)
-            if spammer_data:
-                message = json.dumps(
-                    {
-                        "user_id": user_id,
-                        "lols_bot_data": spammer_data["lols_bot_data"],
-                        "cas_chat_data": spammer_data["cas_chat_data"],
-                        "p2p_data": spammer_data["p2p_data"],
-                    }
+        """Synchronize spammer data with a newly connected peer.
+
+        Rows are read one page at a time in a worker thread, and each page is
+        written to the peer before the next is read, so only one page of the
+        table is held in memory.
+        """
+        peer = protocol.address
+        count = 0
+        after_user_id = ""
+        while True:
+            rows = yield deferToThread(
+                retrieve_spammer_data_page, after_user_id, P2P_SYNC_BATCH_SIZE
+            )
+            if not rows:
+                break
+            if self.peers_by_address.get((peer.host, peer.port)) is not protocol:
+                LOGGER.info(
+                    "Peer %s:%d left during synchronization", peer.host, peer.port
                 )
-                protocol.transport.write(message.encode("utf-8"))
-                LOGGER.info("Synchronized spammer data for user_id: %s", user_id)
+                return
+            after_user_id = rows[-1][0]
+            self._send_spammer_rows(protocol, rows)
+            protocol.flush()
+            count += len(rows)
+        LOGGER.info(
+            "Synchronized %d spammer record(s) with %s:%d",
+            count,
+            peer.host,
+            peer.port,
+        )
+
+    def _send_spammer_rows(self, protocol, rows):
+        """Send spammer rows to a peer in spammers messages of bounded size."""
+        message_cache = self.message_cache
+        # Rows read in the thread may already be stale, so only the cache is
+        # trusted and rows missing from it are encoded without being cached
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            message = message_cache.get(row[0]) or encode_spammer_message(*row)
+            # Batches stay well below the receiver's MAX_LENGTH, whatever the
+            # size of the individual records
+            if batch and (
+                len(batch) >= P2P_SYNC_BATCH_SIZE
+                or batch_bytes + len(message) > P2P_SYNC_BATCH_BYTES
+            ):
+                self._send_spammer_batch(protocol, batch)
+                batch = []
+                batch_bytes = 0
+            batch.append(message)
+            batch_bytes += len(message) + 1
+        if batch:
+            self._send_spammer_batch(protocol, batch)
+
+    def _send_spammer_batch(self, protocol, messages):
+        """Send encoded spammer messages to a peer as one spammers message."""
+        protocol.sendString(b'{"spammers":[%s]}' % b",".join(messages))
 
-    def get_all_spammer_ids(self):
-        """Retrieve all spammer IDs from the database."""
-        return get_all_spammer_ids()
 
+def find_available_port(start_port=0):
+    """Return start_port if it is free, otherwise a port picked by the OS.
 
-def find_available_port(start_port):
-    """Find an available port starting from the given port."""
-    port = start_port
-    while True:
+    The probe socket is closed before returning, unlike a Twisted listener it
+    does not keep holding the port it found.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        # Twisted listeners set SO_REUSEADDR on POSIX, so a port with
+        # connections in TIME_WAIT is free for them and must be for the probe
+        if os.name == "posix":
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         try:
-            endpoint = endpoints.TCP4ServerEndpoint(reactor, port)
-            endpoint.listen(protocol.Factory())
-            return port
-        except error.CannotListenError:
-            port += 1
+            sock.bind(("", start_port))
+        except OSError:
+            sock.bind(("", 0))
+        return sock.getsockname()[1]
 
 
 def check_p2p_data(user_id):
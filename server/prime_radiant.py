@@ -1,13 +1,12 @@
 import sys
-import uuid
 from twisted.internet import reactor, endpoints
 from twisted.internet.error import CannotListenError
 from twisted.web import resource, server
 
-from p2p import P2PFactory, find_available_port
+from p2p import P2PFactory, find_available_port, parse_peer_address
 from websocket import SpammerCheckFactory
 from api import SpammerCheckResource
-from database import initialize_database
+from database import close_database, initialize_database
 from config import (
     LOGGER,
     DEFAULT_P2P_PORT,
@@ -22,6 +21,9 @@ def main():
 
     # Initialize the database
     initialize_database()
+    reactor.addSystemEventTrigger(  # pylint: disable=no-member
+        "before", "shutdown", close_database
+    )
 
     if len(sys.argv) < 2:
         port = DEFAULT_P2P_PORT
@@ -30,8 +32,6 @@ def main():
 
     peers = sys.argv[2:]
 
-    node_uuid = str(uuid.uuid4())
-
     LOGGER.info("Starting P2P server on port %d", port)
 
     # Find an available port if the default port is not available
@@ -50,7 +50,7 @@ def main():
     http_endpoint.listen(http_factory)
     LOGGER.info("HTTP server listening on port %d", HTTP_PORT)
 
-    p2p_factory = P2PFactory(node_uuid)
+    p2p_factory = P2PFactory()
     # p2p_endpoint = endpoints.TCP4ServerEndpoint(reactor, port, interface="0.0.0.0")
     p2p_endpoint = endpoints.TCP4ServerEndpoint(reactor, port)
 
@@ -70,9 +70,8 @@ def main():
     )
 
     for peer in peers:
-        peer_host, peer_port = peer.split(":")
-        peer_port = int(peer_port)
-        peer_endpoint = endpoints.TCP4ClientEndpoint(reactor, peer_host, peer_port)
+        peer_host, peer_port = parse_peer_address(peer)
+        peer_endpoint = endpoints.HostnameEndpoint(reactor, peer_host, peer_port)
         peer_endpoint.connect(p2p_factory).addCallback(
             lambda _, host=peer_host, port=peer_port: LOGGER.info(
                 "Connected to peer %s:%d", host, port
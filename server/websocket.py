@@ -7,9 +7,9 @@ This module handles WebSocket connections and spammer checks.
 
 import json
 import logging
-from twisted.internet import defer, reactor
+from twisted.internet import reactor
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
-from api import APIClient
+from api import check_static_apis, is_spammer_data, is_valid_user_id
 
 LOGGER = logging.getLogger(__name__)
 
@@ -25,29 +25,20 @@ class SpammerCheckProtocol(WebSocketServerProtocol):
             message = payload.decode("utf-8")
             LOGGER.info("Text message received: %s", message)
             data = json.loads(message)
-            user_id = data.get("user_id")
+            user_id = str(data.get("user_id", ""))
             polling_duration = data.get(
                 "polling_duration", 2 * 60 * 60
             )  # Default to 2 hours
-            if user_id:
+            if is_valid_user_id(user_id):
                 self.check_spammer(user_id, polling_duration)
+            else:
+                LOGGER.warning("Invalid user_id received: %s", user_id)
 
     def check_spammer(self, user_id, polling_duration):
         """Check if the user is a spammer using the LOLS and CAS APIs."""
-        api_client_lols = APIClient("api.lols.bot")
-        api_client_cas = APIClient("api.cas.chat")
-        lols_bot_url = f"https://api.lols.bot/account?id={user_id}"
-        cas_chat_url = f"https://api.cas.chat/check?user_id={user_id}"
-
-        d1 = api_client_lols.fetch_data(lols_bot_url)
-        d2 = api_client_cas.fetch_data(cas_chat_url)
 
         def handle_response(responses):
-            lols_bot_response, cas_chat_response = responses
-            LOGGER.info("LOLS bot response: %s", lols_bot_response.decode("utf-8"))
-            LOGGER.info("CAS chat response: %s", cas_chat_response.decode("utf-8"))
-            lols_bot_data = json.loads(lols_bot_response.decode("utf-8"))
-            cas_chat_data = json.loads(cas_chat_response.decode("utf-8"))
+            lols_bot_data, cas_chat_data = responses
 
             response = {
                 "lols_bot": lols_bot_data,
@@ -56,24 +47,13 @@ class SpammerCheckProtocol(WebSocketServerProtocol):
             self.sendMessage(json.dumps(response).encode("utf-8"))
             LOGGER.info("Response sent: %s", response)
 
-            if not (
-                lols_bot_data.get("banned")
-                or (
-                    cas_chat_data.get("result")
-                    and cas_chat_data["result"].get("offenses", 0) > 0
-                )
-            ):
+            if not is_spammer_data(lols_bot_data, cas_chat_data):
                 self.start_exponential_backoff_polling(user_id, polling_duration)
 
-        defer.gatherResults([d1, d2]).addCallback(handle_response)
+        check_static_apis(user_id).addCallback(handle_response)
 
     def start_exponential_backoff_polling(self, user_id, polling_duration):
         """Start polling with exponential backoff to check if the user is a spammer."""
-        api_client_lols = APIClient("api.lols.bot")
-        api_client_cas = APIClient("api.cas.chat")
-        lols_bot_url = f"https://api.lols.bot/account?id={user_id}"
-        cas_chat_url = f"https://api.cas.chat/check?user_id={user_id}"
-
         interval = 60  # Start with a 1-minute interval
         end_time = reactor.seconds() + polling_duration # pylint: disable=no-member
 
@@ -82,15 +62,8 @@ class SpammerCheckProtocol(WebSocketServerProtocol):
                 LOGGER.info("Polling duration ended.")
                 return
 
-            d1 = api_client_lols.fetch_data(lols_bot_url)
-            d2 = api_client_cas.fetch_data(cas_chat_url)
-
             def handle_response(responses):
-                lols_bot_response, cas_chat_response = responses
-                LOGGER.info("LOLS bot response: %s", lols_bot_response.decode("utf-8"))
-                LOGGER.info("CAS chat response: %s", cas_chat_response.decode("utf-8"))
-                lols_bot_data = json.loads(lols_bot_response.decode("utf-8"))
-                cas_chat_data = json.loads(cas_chat_response.decode("utf-8"))
+                lols_bot_data, cas_chat_data = responses
 
                 response = {
                     "lols_bot": lols_bot_data,
@@ -99,7 +72,7 @@ class SpammerCheckProtocol(WebSocketServerProtocol):
                 self.sendMessage(json.dumps(response).encode("utf-8"))
                 LOGGER.info("Polling response sent: %s", response)
 
-                if lols_bot_data.get("banned") or cas_chat_data.get("ok"):
+                if is_spammer_data(lols_bot_data, cas_chat_data):
                     LOGGER.info("User detected as spammer during polling.")
                     return
 
@@ -107,7 +80,7 @@ class SpammerCheckProtocol(WebSocketServerProtocol):
                 interval = min(interval * 2, 3600)  # Max interval of 1 hour
                 reactor.callLater(interval, poll) # pylint: disable=no-member
 
-            defer.gatherResults([d1, d2]).addCallback(handle_response)
+            check_static_apis(user_id).addCallback(handle_response)
 
         poll()
 